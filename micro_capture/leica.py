@@ -1,5 +1,6 @@
 # Interacting with Leica microscope
 
+import bisect
 import enum
 import logging
 import os
@@ -12,6 +13,18 @@ if os.name == 'nt':
 import usb.core
 import usb.util
 
+__all__ = [
+    "CaptureStatus",
+    "CaptureSequence",
+    "CaptureStatusFlags",
+    "LeicaEZ4HD",
+    "URB_IN",
+    "URB_OUT",
+    "exposure",
+    "reverse_exposure",
+    "write_image",
+]
+
 logger = logging.getLogger(__name__)
 
 class CaptureStatus(enum.IntFlag):
@@ -27,16 +40,31 @@ class CaptureSequence(enum.IntFlag):
 
 
 class CaptureStatusFlags:
+    __slots__ = ("capture_sequence", "capture_status")
+
     def __init__(self, raw_status):
-        _, self.capture_sequence, self.capture_status, _ = struct.unpack(
-            ">BBBB", raw_status)
-        self.capture_sequence = CaptureSequence(self.capture_sequence)
-        self.capture_status = CaptureStatus(self.capture_status)
+        self.capture_sequence = CaptureSequence(raw_status[1])
+        self.capture_status = CaptureStatus(raw_status[2])
 
 
 URB_OUT = 0x40
 URB_IN = 0xc0
 
+# constant control transfer payloads
+_ONE_U16 = struct.pack("<H", 1)
+_RES_2048x1536 = struct.pack("<HH", 2048, 1536)
+
+# image metadata: file name, unknown, image size, unknown
+_IMG_META_FMT = struct.Struct("<16sIII")
+
+# size of each bulk read. a read that times out loses whatever it had
+# received, and transfers end on a timeout, so keep this at the size known to
+# work with the device until larger reads have been tested against it
+_BULK_READ_SIZE = 102400
+
+# log bulk transfer progress every this many reads (power of two)
+_DBG_EVERY = 16
+
 exposure = {
     2	: 0x7F,
     2.6	: 0x7A,
@@ -135,6 +163,39 @@ exposure = {
 }
 
 reverse_exposure = {v: k for k, v in exposure.items()}
+
+# exposure durations in ascending order for nearest-value lookups
+_EXPOSURE_KEYS = tuple(sorted(exposure.keys()))
+_EXPOSURE_VALS = tuple(exposure[k] for k in _EXPOSURE_KEYS)
+
+def write_image(filename, data):
+    """
+    Write image data straight to a file with os.write, skipping Python's
+    buffered I/O layer. The data goes to a ".part" file that is renamed into
+    place once complete, so filename never holds a truncated image.
+    :param filename: Filename to save the image data to
+    :param data: The image data (bytes-like)
+    :return: None
+    """
+    part = filename + ".part"
+    view = memoryview(data)
+    fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC |
+                 getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        try:
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        os.replace(part, filename)
+    except BaseException:
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+        raise
+
+
 class LeicaEZ4HD:
     def __init__(self):
         idVendor = 0x1711
@@ -150,27 +211,81 @@ class LeicaEZ4HD:
         self.dev.set_configuration()
         self.cfg = self.dev.get_active_configuration()
 
-    def _wait_for_capture_status(self, capture_status, sleep=0):
+        # reused by every image transfer. pyusb only reads into array.array
+        # buffers it can take the address of, so this cannot be backed by
+        # libusb_dev_mem_alloc (zero-copy) memory without bypassing pyusb
+        self._bulk_buf = usb.util.create_buffer(_BULK_READ_SIZE)
+
+    def close(self):
+        """
+        Release the USB resources held for the microscope.
+        :return: None
+        """
+        usb.util.dispose_resources(self.dev)
+
+    def _wait_for_capture_status(self, capture_status, max_sleep=0, min_sleep=1):
+        # back off exponentially from min_sleep to max_sleep (in ms), starting
+        # over whenever the device reports a new status
+        _ctrl = self.dev.ctrl_transfer
+        _sleep = time.sleep
+        max_delay = max_sleep / 1000.0
+        min_delay = min(min_sleep, max_sleep) / 1000.0
+        target = int(capture_status)
+        delay = min_delay
+        last_status = None
         while True:
             # read from 0xd000 4 bytes
-            resp = self.dev.ctrl_transfer(URB_IN, 0x01, 0xd000, 0x0000, 0x0004)
-            flags = CaptureStatusFlags(resp)
-            logger.debug("%s: %s %s", hex(int.from_bytes(resp, "big")),
-                  flags.capture_sequence, flags.capture_status)
-            if flags.capture_status == capture_status:
+            resp = _ctrl(URB_IN, 0x01, 0xd000, 0x0000, 0x0004)
+            seq = resp[1]
+            status = resp[2]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%02x%02x%02x%02x: %s %s", resp[0], seq, status,
+                             resp[3], CaptureSequence(seq), CaptureStatus(status))
+            if status == target:
                 break
-            time.sleep(sleep/1000)
-
-    def _wait_for_capture_sequence(self, capture_sequence, sleep=0):
+            if status != last_status:
+                last_status = status
+                delay = min_delay
+            _sleep(delay)
+            delay = min(max_delay, delay*2)
+
+    def _wait_for_capture_sequence(self, capture_sequence, max_sleep=0, min_sleep=1):
+        self._wait_for_sequence_chain([capture_sequence], max_sleep, min_sleep)
+
+    def _wait_for_sequence_chain(self, seq_list, max_sleep=0, min_sleep=1):
+        # wait for the device to pass through each sequence in seq_list in
+        # order, polling once per iteration and backing off exponentially from
+        # min_sleep to max_sleep (in ms) until the sequence changes
+        _ctrl = self.dev.ctrl_transfer
+        _sleep = time.sleep
+        max_delay = max_sleep / 1000.0
+        min_delay = min(min_sleep, max_sleep) / 1000.0
+        targets = [int(s) for s in seq_list]
+        target = targets[0]
+        idx = 0
+        delay = min_delay
+        last_sequence = None
         while True:
             # read from 0xd000 4 bytes
-            resp = self.dev.ctrl_transfer(URB_IN, 0x01, 0xd000, 0x0000, 0x0004)
-            flags = CaptureStatusFlags(resp)
-            logger.debug("%s: %s %s", hex(int.from_bytes(resp, "big")),
-                  flags.capture_sequence, flags.capture_status)
-            if flags.capture_sequence == capture_sequence:
-                break
-            time.sleep(sleep/1000)
+            resp = _ctrl(URB_IN, 0x01, 0xd000, 0x0000, 0x0004)
+            seq = resp[1]
+            status = resp[2]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%02x%02x%02x%02x: %s %s", resp[0], seq, status,
+                             resp[3], CaptureSequence(seq), CaptureStatus(status))
+            if seq == target:
+                idx += 1
+                if idx == len(targets):
+                    break
+                target = targets[idx]
+                last_sequence = seq
+                delay = min_delay
+                continue
+            if seq != last_sequence:
+                last_sequence = seq
+                delay = min_delay
+            _sleep(delay)
+            delay = min(max_delay, delay*2)
 
     def compute_auto_exposure(self, duration=10):
         """
@@ -199,14 +314,18 @@ class LeicaEZ4HD:
                 break
     
     def _set_exposure(self, duration):
-        try:
-            setting = 0x6000 | exposure[duration]
-        except KeyError:
-            raise ValueError("Invalid exposure value")
+        # snap to the nearest supported exposure duration
+        i = bisect.bisect_left(_EXPOSURE_KEYS, duration)
+        i = min(i, len(_EXPOSURE_KEYS) - 1)
+        if i > 0 and abs(_EXPOSURE_KEYS[i-1] - duration) < abs(_EXPOSURE_KEYS[i] - duration):
+            i -= 1
+        if _EXPOSURE_KEYS[i] != duration:
+            logger.debug("using exposure %s for requested %s", _EXPOSURE_KEYS[i], duration)
+        setting = 0x6000 | _EXPOSURE_VALS[i]
 
         self.dev.ctrl_transfer(URB_OUT, 0x01, setting, 0x0000)
 
-    def _perform_capture(self):
+    def _perform_capture(self, on_captured=None):
         self.dev.ctrl_transfer(URB_IN, 0x01, 0x6400, 0x0000, 2)
         self.dev.ctrl_transfer(URB_IN, 0x01, 0x6400, 0x0000, 2)
 
@@ -221,11 +340,11 @@ class LeicaEZ4HD:
 
         self.dev.ctrl_transfer(URB_IN, 0x01, 0xba00, 0x00c0, 2)
 
-        self.dev.ctrl_transfer(URB_OUT, 0x01, 0xeb00, 0x0000, struct.pack("<H", 1))
-        self.dev.ctrl_transfer(URB_OUT, 0x01, 0xeb01, 0x0000, struct.pack("<H", 1))
+        self.dev.ctrl_transfer(URB_OUT, 0x01, 0xeb00, 0x0000, _ONE_U16)
+        self.dev.ctrl_transfer(URB_OUT, 0x01, 0xeb01, 0x0000, _ONE_U16)
 
         # set capture resolution to 2048x1536
-        self.dev.ctrl_transfer(URB_OUT, 0x01, 0x4650, 0x0000, struct.pack("<HH", 2048, 1536))
+        self.dev.ctrl_transfer(URB_OUT, 0x01, 0x4650, 0x0000, _RES_2048x1536)
 
         # trigger a switch to capture mode
         self.dev.ctrl_transfer(URB_OUT, 0x01, 0x1f40, 0x0000)
@@ -236,54 +355,90 @@ class LeicaEZ4HD:
         # trigger capture
         self.dev.ctrl_transfer(URB_OUT, 0x01, 0x1f50, 0x0000)
 
-        logger.debug("waiting for capture to start")
-        self._wait_for_capture_sequence(CaptureSequence.CAPTURING, 50)
-        logger.debug("waiting for capture to finish")
-        self._wait_for_capture_sequence(CaptureSequence.CAPTURED, 50)
-        logger.debug("waiting for ready")
-        self._wait_for_capture_sequence(CaptureSequence.READY, 50)
+        logger.debug("waiting for capture to start, finish, and return to ready")
+        self._wait_for_sequence_chain([CaptureSequence.CAPTURING,
+                                       CaptureSequence.CAPTURED,
+                                       CaptureSequence.READY], 50)
+
+        # the exposure is done and the image is held on the device
+        if on_captured is not None:
+            on_captured()
+
 
+    def _arm_image_transfer(self):
+        # issued back-to-back before the metadata read and the bulk transfer
+        self.dev.ctrl_transfer(URB_OUT, 0x01, 0xae00, 0x0000, _ONE_U16)
+        self.dev.ctrl_transfer(URB_OUT, 0x01, 0xb200, 0x0000, _ONE_U16)
 
     def _transfer_image(self, exposure=2000):
         logger.debug("waiting for image to be ready for transfer")
         self._wait_for_capture_status(CaptureStatus.IMG_READY, 50)
 
         logger.debug("reading image metadata")
-        self.dev.ctrl_transfer(URB_OUT, 0x01, 0xae00, 0x0000, struct.pack("<H", 1))
-        self.dev.ctrl_transfer(URB_OUT, 0x01, 0xb200, 0x0000, struct.pack("<H", 1))
+        self._arm_image_transfer()
 
         # read 64 bytes with the image size embedded
         resp = self.dev.ctrl_transfer(URB_IN, 0x01, 0xb900, 0x0000, 64)
-        file_name, _, image_size, _ = struct.unpack("<16sIII", resp)
+        file_name, _, image_size, _ = _IMG_META_FMT.unpack(resp)
         logger.debug("image size: %d", image_size)
 
-        # transmit the image data
-        self.dev.ctrl_transfer(URB_OUT, 0x01, 0xae00, 0x0000, struct.pack("<H", 1))
-        self.dev.ctrl_transfer(URB_OUT, 0x01, 0xb200, 0x0000, struct.pack("<H", 1))
+        # transmit the image data. the arm writes are repeated here as in the
+        # captured vendor driver traffic; dropping them has not been verified
+        # against the device
+        self._arm_image_transfer()
         self. dev.ctrl_transfer(URB_OUT, 0x01, 0x9300, 0x0000)
 
         # track how much we have left to transfer
         data_size = image_size # - final_block_size
-        image_data = bytearray()
-
-        max_read_size = 102400
-        buf = usb.util.create_buffer(max_read_size)
+        image_data = bytearray(image_size)
+        image_view = memoryview(image_data)
+        offset = 0
+
+        buf = self._bulk_buf
+        buf_view = memoryview(buf)
+        extra = b""
+        reads = 0
+        timed_out = False
         while data_size > 0:
             try:
                 read_length = self.dev.read(0x81, buf)
             except usb.core.USBTimeoutError:
                 logger.debug("File transfer timed out")
-                # check if the last two bytes conclude the image data
-                if image_data[-2] == 0xff and image_data[-1] == 0xd9:
-                    logger.debug("found end of image")
-                else:
-                    logger.warning("Data transfer timed out, but did not find end of image. File may be incomplete.")
+                timed_out = True
                 # escape data capute
                 break
 
-            image_data.extend(buf[:read_length])
+            # copy straight into the image; anything past the advertised size
+            # is kept and appended once the transfer is done
+            if read_length > data_size:
+                logger.debug("device sent %d bytes past the advertised image size",
+                             read_length - data_size)
+                extra = bytes(buf_view[data_size:read_length])
+                read_length = data_size
+            image_view[offset:offset+read_length] = buf_view[:read_length]
+            offset += read_length
             data_size -= read_length
-            logger.debug("%d bytes read; %d bytes left to read", read_length, data_size)
+            if reads & (_DBG_EVERY - 1) == 0 or data_size <= 0:
+                logger.debug("%d bytes read; %d bytes left to read", offset, data_size)
+            reads += 1
+
+        image_view.release()
+        buf_view.release()
+        del image_data[offset:]
+        image_data += extra
+
+        if timed_out:
+            # check if the last two bytes conclude the image data; the end of
+            # image marker may also land just before the end of the last read
+            if image_data.endswith(b"\xff\xd9"):
+                logger.debug("found end of image")
+            else:
+                eoi = image_data.rfind(b"\xff\xd9", max(0, len(image_data) - 8))
+                if eoi >= 0:
+                    logger.debug("found end of image")
+                    del image_data[eoi+2:]
+                else:
+                    logger.warning("Data transfer timed out, but did not find end of image. File may be incomplete.")
 
         # assert len(image_data) == image_size
 
@@ -301,6 +456,20 @@ class LeicaEZ4HD:
         return image_data
 
 
+    def capture_image_data(self, exposure=2000, on_captured=None):
+        """
+        Capture an image from the microscope and return the JPEG data. The
+        image is encoded by the microscope itself, so no encoding happens on
+        the host and the data can be written to disk as-is.
+        :param exposure: Exposure time in ms to restore after the capture
+        :param on_captured: Optional callable run as soon as the exposure has
+                            finished, before the image is transferred
+        :return: The image data
+        """
+
+        self._perform_capture(on_captured)
+        return self._transfer_image(exposure)
+
     def capture_image(self, filename, exposure=2000):
         """
         Capture an image from the microscope and save it to the given filename.
@@ -308,8 +477,5 @@ class LeicaEZ4HD:
         :return: None
         """
 
-        self._perform_capture()
-        data = self._transfer_image(exposure)
-
-        with open(filename, "wb") as f:
-            f.write(data)
\ No newline at end of file
+        data = self.capture_image_data(exposure)
+        write_image(filename, data)
\ No newline at end of file
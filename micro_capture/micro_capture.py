@@ -1,37 +1,262 @@
+import csv
+import functools
 import logging
 import math
 import os
+import threading
 import time
+from concurrent.futures import ALL_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
 logging.basicConfig(format='%(asctime)s %(message)s', level=logging.INFO)
 
 from printrun.printcore import printcore
 
-from leica import LeicaEZ4HD
+from leica import LeicaEZ4HD, write_image
 
 logger = logging.getLogger(__name__)
 
+# most images waiting to be written at once; each is a few MB
+MAX_PENDING_WRITES = 4
+
+# attempts made to write an image before giving up
+WRITE_ATTEMPTS = 3
+
+# echoed back by the stage (M118) once the M400 before it has completed
+SYNC_TOKEN = "MCSYNC"
+
+# seconds to wait for the stage to report that a move has finished
+STAGE_TIMEOUT = 60
+
+
+class DryRunStage:
+    """
+    Stands in for printcore when running without hardware. Commands are
+    logged and acknowledged immediately.
+    """
+    def __init__(self):
+        self.recvcb = None
+        self.onlinecb = None
+        self.online = False
+        self.printer = None
+
+    def connect(self, port=None, baud=None):
+        self.printer = True
+        self.online = True
+        if self.onlinecb:
+            self.onlinecb()
+
+    def disconnect(self):
+        self.printer = None
+        self.online = False
+
+    def send_now(self, command):
+        for line in command.split("\n"):
+            logger.info(f"dry run: {line}")
+            if self.recvcb and line.startswith("M118 "):
+                self.recvcb(line[len("M118 "):])
 
-class MicroCapture:
-    def __init__(self, device, baudrate):
-        self.device = device
-        self.baudrate = baudrate
 
-        self.stage = printcore(self.device, self.baudrate)
+class DryRunMicroscope:
+    """
+    Stands in for the microscope when running without hardware. Each capture
+    takes capture_time seconds and returns no data.
+    """
+    def __init__(self, capture_time):
+        self.capture_time = capture_time
+
+    def compute_auto_exposure(self, duration=10):
+        pass
 
-        self.microscope = LeicaEZ4HD()
+    def capture_image_data(self, exposure=2000, on_captured=None):
+        time.sleep(self.capture_time)
+        if on_captured is not None:
+            on_captured()
+        return b""
 
-        while not self.stage.online:
-            time.sleep(0.1)
+    def close(self):
+        pass
+
+
+class MicroCapture:
+    def __init__(self, device, baudrate, dry_run=False, capture_time=1.0):
+        """
+        :param device: Device path for the microscope stage
+        :param baudrate: Baudrate for the microscope stage
+        :param dry_run: Run without the stage or microscope (default: False)
+        :param capture_time: Seconds each simulated capture takes in a dry run
+                             (default: 1.0)
+        """
+        self.device = device
+        self.baudrate = baudrate
+        self.dry_run = dry_run
+        self._closed = False
+
+        # images are written to disk in the background so the next stage move
+        # overlaps with the write; pending writes map to their filenames
+        self._pool = None
+        self._pending = {}
+
+        # sequence numbers of the last sync echo requested from and
+        # reported by the stage
+        self._sync_sent = 0
+        self._sync_seen = 0
+        self._synced = threading.Condition()
+        self._online = threading.Event()
+
+        # attach the callbacks before connecting so none are missed
+        self.stage = DryRunStage() if self.dry_run else printcore()
+        self.stage.recvcb = self._on_stage_recv
+        self.stage.onlinecb = self._online.set
+        self.stage.connect(self.device, self.baudrate)
+
+        # release the stage if the microscope can't be opened
+        try:
+            if self.dry_run:
+                self.microscope = DryRunMicroscope(capture_time)
+            else:
+                self.microscope = LeicaEZ4HD()
+        except BaseException:
+            self.stage.disconnect()
+            self._closed = True
+            raise
+
+        self._start_writer()
+
+        self._online.wait()
+        self._set_low_latency()
 
     def connect(self):
+        self._closed = False
+        self._online.clear()
         self.stage.connect()
+        self._start_writer()
 
-        while not self.stage.online:
-            time.sleep(0.1)
+        self._online.wait()
+        self._set_low_latency()
 
     def disconnect(self):
+        self._stop_writer()
         self.stage.disconnect()
+
+    def close(self):
+        """
+        Finish any pending image writes and release the stage and microscope.
+        Every failed write is logged and the first one is raised once both
+        are released.
+        """
+        try:
+            self._drain_writes()
+        finally:
+            self.disconnect()
+            self.microscope.close()
+            self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        try:
+            self.close()
+        except Exception:
+            # failed writes have been logged; don't hide the error that ended
+            # the scan behind them
+            if exc_type is None:
+                raise
+
+    def _set_low_latency(self):
+        # USB-serial adapters buffer incoming data for up to 16ms by default;
+        # ASYNC_LOW_LATENCY makes each G-code reply arrive immediately. pyserial
+        # only supports this on Linux and not every driver accepts it.
+        try:
+            self.stage.printer.set_low_latency_mode(True)
+        except (AttributeError, ValueError) as e:
+            logger.debug(f"Could not enable low latency mode: {e}")
+
+    def _start_writer(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=2)
+
+    def _stop_writer(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def _submit_write(self, filename, data):
+        # once too many images are waiting, block until one is written
+        if len(self._pending) >= MAX_PENDING_WRITES:
+            next(as_completed(self._pending))
+        for future in [f for f in self._pending if f.done()]:
+            failed = self._pending.pop(future)
+            if future.exception() is not None:
+                logger.error(f"Failed to write {failed}: {future.exception()}")
+                raise future.exception()
+        future = self._pool.submit(self._write_with_retry, filename, data)
+        self._pending[future] = filename
+
+    def _write_with_retry(self, filename, data):
+        # retry transient I/O errors (e.g. a busy SD card) with 1s, 2s, ...
+        # backoff rather than aborting the scan
+        for attempt in range(WRITE_ATTEMPTS):
+            try:
+                write_image(filename, data)
+                return
+            except OSError as e:
+                if attempt == WRITE_ATTEMPTS - 1:
+                    raise
+                logger.warning(f"Failed to write {filename} ({e}); retrying")
+                time.sleep(2**attempt)
+
+    def _drain_writes(self):
+        # wait for the writes to finish, logging every failure and raising
+        # the first
+        wait(self._pending, return_when=ALL_COMPLETED)
+        pending, self._pending = self._pending, {}
+        error = None
+        for future, filename in pending.items():
+            if future.exception() is not None:
+                logger.error(f"Failed to write {filename}: {future.exception()}")
+                error = error or future.exception()
+        if error is not None:
+            raise error
+
+    def _on_stage_recv(self, line):
+        # only the echo of our own M118 counts; stray "ok"s (e.g. replies to
+        # printcore's M105 connect probes) say nothing about motion
+        i = line.find(SYNC_TOKEN)
+        if i < 0:
+            return
+        try:
+            seq = int(line[i + len(SYNC_TOKEN):].split()[0])
+        except (IndexError, ValueError):
+            return
+        with self._synced:
+            self._sync_seen = max(self._sync_seen, seq)
+            self._synced.notify_all()
+
+    def _move(self, *commands):
+        """
+        Send G-code moves followed by M400 and an M118 echo of a fresh sync
+        number in a single write. The stage only runs the M118 once M400 has
+        waited for the planner to empty, so the echo means the moves have
+        finished. Keep the combined lines under 64 bytes so they fit in the
+        controller's receive buffer.
+        """
+        with self._synced:
+            self._sync_sent += 1
+            seq = self._sync_sent
+        self.stage.send_now("\n".join(commands + ("M400", f"M118 {SYNC_TOKEN} {seq}")))
+
+    def _wait_for_stage(self, timeout=STAGE_TIMEOUT):
+        """
+        Block until the stage has echoed the sync number of the last _move,
+        i.e. until it has stopped. Sync numbers only increase, so a late echo
+        from an earlier move can never satisfy a newer wait. If the echo does
+        not arrive within timeout seconds, log a warning and carry on.
+        """
+        with self._synced:
+            seq = self._sync_sent
+            if not self._synced.wait_for(lambda: self._sync_seen >= seq, timeout):
+                logger.warning(f"Stage did not report move {seq} finished within {timeout}s")
     
     def compute_auto_exposure(self, duration=10):
         """
@@ -43,46 +268,134 @@ class MicroCapture:
         self.microscope.compute_auto_exposure(duration)
         logger.info("Auto exposure computed")
 
-    def capture(self, x_steps, x_step_size, y_steps, y_step_size, output_dir, exposure, feedrate=300):
+    def capture(self, x_steps, x_step_size, y_steps, y_step_size, output_dir, exposure, feedrate=300, profile=None,
+                resume=False, pixels_per_mm=None):
+        """
+        Capture a zig-zag grid of images, starting from the stage's current
+        position. Each tile is pipelined: the move to tile k+1 starts as soon
+        as the exposure of tile k is done and overlaps its transfer; once
+        transferred, tile k is written in the background while the move
+        finishes and the following tiles are captured.
+        :param x_steps: Number of tiles in the x direction
+        :param x_step_size: Distance in mm between tiles in the x direction
+        :param y_steps: Number of tiles in the y direction
+        :param y_step_size: Distance in mm between tiles in the y direction
+        :param output_dir: Directory to save the images to
+        :param exposure: Exposure time in ms
+        :param feedrate: Stage feedrate in mm/min (default: 300)
+        :param profile: Optional CSV filename for per-tile timings
+        :param resume: Skip tiles already saved in output_dir (default: False)
+        :param pixels_per_mm: Image pixels per mm of stage travel, used to
+                              write TileConfiguration.txt in pixels; if unset
+                              the positions are written in mm (default: None)
+        :return: None
+        """
         if not self.stage.printer:
             self.connect()
 
-        self.stage.send("G91")
-        self.stage.send(f"G0 F{feedrate}")
-        self.stage.send("G0 X0 Y0")
+        # the scan starts wherever the stage is now; make that the origin and
+        # address every tile by absolute position
+        self._move("G92 X0 Y0", "G90", f"G0 F{feedrate}")
 
-        # Add a 20% buffer to the pause factor
-        pause_factor = 60 / feedrate * 1.2
+        # a dry run leaves the output directory untouched
+        if not self.dry_run:
+            os.makedirs(output_dir, exist_ok=True)
 
+        # we are going to do a zig-zag pattern so this is go negative on even
+        # rows, go positive on odd rows. positions are formatted once with
+        # three decimals to keep float noise out of the G-code
+        tiles = []
         for y in range(y_steps):
-            for x in range(x_steps):
-                col = x if y % 2 == 0 else x_steps - x - 1
-                filename = os.path.join(
-                    output_dir, f"img_r{y:03}_c{col:03}.jpg")
-                self.microscope.capture_image(filename, exposure)
+            cols = range(x_steps) if y % 2 == 0 else reversed(range(x_steps))
+            for col in cols:
+                filename = os.path.join(output_dir, f"img_r{y:03}_c{col:03}.jpg")
+                goto = f"G0 X{-col*x_step_size:.3f} Y{-y*y_step_size:.3f}"
+                tiles.append((y, col, filename, goto))
+
+        # when resuming, skip the tiles that were already captured; the stage
+        # must start from the same origin as the original scan
+        done = []
+        if resume:
+            todo = []
+            for t in tiles:
+                (done if os.path.exists(t[2]) else todo).append(t)
+            tiles = todo
+            logger.info(f"Resuming scan with {len(tiles)} of {len(tiles) + len(done)} tiles left")
+            if tiles:
+                self._move(tiles[0][3])
+
+        # the stage works through the setup while the scan is planned
+        self._wait_for_stage()
+
+        # stitching layout for Fiji's Grid/Collection stitching, written as the
+        # scan goes so a partial scan still leaves a usable file. Fiji expects
+        # pixels; without a scale the stage position in mm is written instead
+        # and has to be converted before stitching
+        scale = pixels_per_mm or 1
+        if pixels_per_mm:
+            units = "pixels"
+        else:
+            units = "stage mm; multiply by pixels per mm before stitching"
+
+        def layout(y, col, filename):
+            return (f"{os.path.basename(filename)}; ; "
+                    f"({col*x_step_size*scale:.3f}, {y*y_step_size*scale:.3f})\n")
+
+        tile_config = os.path.join(output_dir, "TileConfiguration.txt")
+        if self.dry_run:
+            tile_config = os.devnull
+        with open(tile_config, "w") as cfg:
+            cfg.write("# Define the number of dimensions we are working on\n")
+            cfg.write("dim = 2\n\n")
+            cfg.write(f"# Define the image coordinates ({units})\n")
+            for y, col, filename, _ in done:
+                cfg.write(layout(y, col, filename))
+
+            timings = []
+            for i, (y, col, filename, _) in enumerate(tiles):
+                start = time.monotonic()
+                # move to every tile but the last
+                move = None
+                if i < len(tiles) - 1:
+                    next_y, next_col, _, move = tiles[i + 1]
+                    logger.debug(f"Moving to row {next_y} column {next_col}")
+
+                # start the next move as soon as the exposure is done so the
+                # stage moves while the image is transferred
+                on_captured = functools.partial(self._move, move) if move else None
+                data = self.microscope.capture_image_data(exposure, on_captured)
 
                 logger.info(f"Captured image at row {y} column {col}")
-
-                # move all but the last step in the x direction
-                if x < x_steps - 1:
-                    logger.debug(f"Moving to next column {col}")
-                    # we are going to do a zig-zag pattern so this is go negative on
-                    # even rows, go positive on odd rows
-                    if y % 2 == 0:
-                        self.stage.send(f"G0 X-{x_step_size}")
-                    else:
-                        self.stage.send(f"G0 X{x_step_size}")
-
-                    time.sleep(pause_factor*x_step_size)
-
-            # move in the y direction all but the last iteration
-            logger.debug(f"Moving to next row {y}")
-            if y < y_steps - 1:
-                self.stage.send(f"G0 Y-{y_step_size}")
-                time.sleep(pause_factor*y_step_size)
+                captured = time.monotonic()
+
+                cfg.write(layout(y, col, filename))
+                if move is None or next_y != y:
+                    cfg.flush()
+
+                # time the hand-off to the writer (which blocks when too many
+                # writes are pending) apart from the wait for the stage
+                submitted = time.monotonic()
+                if not self.dry_run:
+                    self._submit_write(filename, data)
+                written = time.monotonic()
+                if move:
+                    self._wait_for_stage()
+                timings.append((y, col, captured - start, written - submitted,
+                                time.monotonic() - written))
+
+        self._drain_writes()
+
+        if profile:
+            with open(profile, "w", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["row", "column", "capture_s", "write_s", "stage_s"])
+                writer.writerows(timings)
 
     def __del__(self):
-        self.disconnect()
+        # nothing to release if close() already ran or __init__ failed before
+        # the stage was connected
+        if not getattr(self, "_closed", True) and hasattr(self, "stage"):
+            self.disconnect()
 
 
 if __name__ == '__main__':
@@ -92,9 +405,13 @@ if __name__ == '__main__':
         description='Capture a grid of images from a microscope')
     
     parser.add_argument('--device', '-d', type=str,
-                         required=True, help='Device path for microscope stage')
+                         help='Device path for microscope stage')
     parser.add_argument('--baudrate', '-b', type=int,
                          default=115200, help='Baudrate for microscope stage')
+    parser.add_argument('--dry-run', action='store_true',
+                         help='Run without the stage or microscope')
+    parser.add_argument('--capture-time', type=float, default=1.0,
+                         help='Seconds each simulated capture takes with --dry-run (default: 1.0)')
 
 
     subparsers = parser.add_subparsers(dest="command", help="sub-command help")
@@ -110,6 +427,12 @@ if __name__ == '__main__':
                          help='Height of the grid in the y direction in mm')
     capture.add_argument('--y-step-size', '-m', type=float,
                          required=True, help='Number of mm to move in the y direction')
+    capture.add_argument('--profile', '-p',
+                         help='Write per-tile capture, write and stage timings to this CSV file')
+    capture.add_argument('--resume', '-r', action='store_true',
+                         help='Skip tiles already in the output directory; the stage must be back at the original starting position')
+    capture.add_argument('--pixels-per-mm', type=float,
+                         help='Image pixels per mm of stage travel; TileConfiguration.txt is written in pixels when set and in mm otherwise')
     
 
     expose = subparsers.add_parser('expose', help='Compute auto exposure')
@@ -118,14 +441,15 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
-    m = MicroCapture(args.device, args.baudrate)
+    if args.device is None and not args.dry_run:
+        parser.error("the following arguments are required: --device/-d")
 
-    if args.command == "capture":
-        x_steps = math.ceil(args.x_distance / args.x_step_size)
-        y_steps = math.ceil(args.y_distance / args.y_step_size)
-        m.capture(x_steps, args.x_step_size, y_steps, args.y_step_size, args.output_dir, args.exposure)
+    with MicroCapture(args.device, args.baudrate, args.dry_run, args.capture_time) as m:
+        if args.command == "capture":
+            x_steps = math.ceil(args.x_distance / args.x_step_size)
+            y_steps = math.ceil(args.y_distance / args.y_step_size)
+            m.capture(x_steps, args.x_step_size, y_steps, args.y_step_size, args.output_dir, args.exposure,
+                      profile=args.profile, resume=args.resume, pixels_per_mm=args.pixels_per_mm)
 
-    elif args.command == "expose":
-        m.compute_auto_exposure(args.duration)
-    
-    m.disconnect()
\ No newline at end of file
+        elif args.command == "expose":
+            m.compute_auto_exposure(args.duration)
\ No newline at end of file